@@ -5,7 +5,8 @@ Main Streamlit Application Interface
 
 import streamlit as st
 import os
-from rag_engine import MedicalRAGEngine
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from rag_engine import MedicalRAGEngine, ResponseCache, SEMANTIC_CACHE_SIZE
 
 # Page Configuration
 st.set_page_config(
@@ -45,6 +46,22 @@ if 'rag_engine' not in st.session_state:
     st.session_state.rag_engine = None
 if 'chat_history' not in st.session_state:
     st.session_state.chat_history = []
+# Answers stay within the session that asked; the engine itself is shared
+if 'response_cache' not in st.session_state:
+    st.session_state.response_cache = ResponseCache()
+
+# Queries built from patient data only reuse answers for identical input
+EXACT_MATCH_QUERY_TYPES = {"patient_case", "lab_analysis"}
+
+@st.cache_resource(show_spinner=False)
+def get_engine(api_key: str) -> MedicalRAGEngine:
+    """Shared RAG engine per API key, reused across sessions and reruns"""
+    return MedicalRAGEngine(api_key=api_key)
+
+@st.cache_data(show_spinner=False, ttl=3600, max_entries=SEMANTIC_CACHE_SIZE)
+def embed_question(question: str, api_key: str) -> list:
+    """Question embedding, memoized so repeated questions skip the embedding RPC"""
+    return get_engine(api_key).embeddings.embed_query(question)
 
 def initialize_rag_system():
     """Initialize RAG engine with API key"""
@@ -53,7 +70,12 @@ def initialize_rag_system():
         if not api_key:
             return False
         
-        st.session_state.rag_engine = MedicalRAGEngine(api_key=api_key)
+        # Reruns or repeated clicks with the same key keep the current engine
+        existing = st.session_state.get('rag_engine')
+        if existing and existing.api_key == api_key:
+            return True
+        
+        st.session_state.rag_engine = get_engine(api_key)
         return True
     except Exception as e:
         st.error(f"Error initializing RAG system: {str(e)}")
@@ -61,7 +83,10 @@ def initialize_rag_system():
 
 # New helper to clear inputs + chat history
 def clear_all_inputs_and_history():
-    """Clear chat history and all input widgets across tabs (but keep API key and rag engine)"""
+    """Clear chat history and all input widgets across tabs (but keep API key and rag engine)
+
+    The engine itself lives in the st.cache_resource cache and is never touched here.
+    """
     keys_to_clear = [
         "general_query",
         "uploaded_files",
@@ -76,10 +101,11 @@ def clear_all_inputs_and_history():
     for k in keys_to_clear:
         if k in st.session_state:
             del st.session_state[k]
-    # Clear chat history
+    # Clear chat history and the answers cached for it
     st.session_state.chat_history = []
+    st.session_state.response_cache = ResponseCache()
     # Rerun to reflect cleared UI
-    st.experimental_rerun()
+    st.rerun()
 
 def main():
     # Header
@@ -120,13 +146,34 @@ def main():
         
         if uploaded_files and st.session_state.rag_engine:
             if st.button("📥 Process Documents"):
-                with st.spinner("Processing medical literature..."):
-                    for file in uploaded_files:
-                        try:
-                            st.session_state.rag_engine.add_document(file)
-                            st.success(f"✅ Processed: {file.name}")
-                        except Exception as e:
-                            st.error(f"❌ Error processing {file.name}: {str(e)}")
+                with st.status("Processing medical literature...") as status:
+                    rag_engine = st.session_state.rag_engine
+                    # Parse and embed files concurrently; UI updates stay on this thread
+                    failed = 0
+                    with ThreadPoolExecutor(max_workers=4) as executor:
+                        futures = {executor.submit(rag_engine.add_document, file): file
+                                   for file in uploaded_files}
+                        for future in as_completed(futures):
+                            file = futures[future]
+                            try:
+                                result = future.result()
+                                if result['status'] == 'success':
+                                    st.success(f"✅ Processed: {file.name}")
+                                elif result['status'] == 'skipped':
+                                    st.info(f"ℹ️ Already processed: {file.name}")
+                                else:
+                                    failed += 1
+                                    st.error(f"❌ Error processing {file.name}: {result['error']}")
+                            except Exception as e:
+                                failed += 1
+                                st.error(f"❌ Error processing {file.name}: {str(e)}")
+                    # Persist once for the whole batch
+                    rag_engine.flush()
+                    if failed:
+                        status.update(label=f"{failed} of {len(uploaded_files)} documents failed",
+                                      state="error")
+                    else:
+                        status.update(label="Medical literature processed", state="complete")
         
         st.divider()
         
@@ -174,6 +221,9 @@ def main():
             with st.chat_message(message["role"]):
                 st.markdown(message["content"])
         
+        # New messages render here, directly below the history, not inside the tab
+        new_messages = st.container()
+        
         # Input tabs
         tab1, tab2, tab3 = st.tabs(["💬 General Query", "🩺 Patient Case", "🔬 Lab Analysis"])
         
@@ -187,7 +237,7 @@ def main():
             
             if st.button("🔍 Analyze", key="general"):
                 if query:
-                    process_query(query, "general")
+                    process_query(query, "general", new_messages)
         
         with tab2:
             st.markdown("#### Patient Information")
@@ -224,7 +274,7 @@ def main():
                 
                 Provide structured clinical reasoning with differential diagnosis and next steps.
                 """
-                process_query(patient_query, "patient_case")
+                process_query(patient_query, "patient_case", new_messages)
         
         with tab3:
             lab_data = st.text_area(
@@ -258,20 +308,30 @@ def main():
                 
                 Provide interpretation, clinical significance, and recommendations.
                 """
-                process_query(lab_query, "lab_analysis")
+                process_query(lab_query, "lab_analysis", new_messages)
 
-def process_query(query: str, query_type: str):
-    """Process user query through RAG engine"""
+def process_query(query: str, query_type: str, container):
+    """Process user query through RAG engine, rendering the exchange into container"""
     try:
         # Add user message to chat
         st.session_state.chat_history.append({
             "role": "user",
             "content": query
         })
+        with container.chat_message("user"):
+            st.markdown(query)
         
-        # Get response from RAG engine
-        with st.spinner("🔍 Analyzing medical literature and generating response..."):
-            response = st.session_state.rag_engine.query(query)
+        # Stream response from RAG engine; a repeated question reuses its cached
+        # embedding and is answered from the session's response cache without any RPC
+        rag_engine = st.session_state.rag_engine
+        query_vec = embed_question(query, rag_engine.api_key)
+        with container.chat_message("assistant"):
+            response = st.write_stream(rag_engine.stream_query(
+                query,
+                query_vec=query_vec,
+                cache=st.session_state.response_cache,
+                exact_match=query_type in EXACT_MATCH_QUERY_TYPES
+            ))
         
         # Add assistant response to chat without HTML wrapper
         st.session_state.chat_history.append({
@@ -279,9 +339,6 @@ def process_query(query: str, query_type: str):
             "content": response
         })
         
-        # Rerun to display updated chat
-        st.rerun()
-        
     except Exception as e:
         st.error(f"Error processing query: {str(e)}")
 
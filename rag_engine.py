@@ -4,18 +4,264 @@ Handles document processing, embedding, and clinical reasoning
 """
 
 import os
+import re
+import time
+import uuid
+import random
+import hashlib
 import tempfile
-from typing import List, Dict, Any
+import threading
+from typing import List, Dict, Any, Optional, Iterator
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 
 # Core dependencies
-import google.generativeai as genai
-from langchain_google_genai import GoogleGenerativeAIEmbeddings, ChatGoogleGenerativeAI
-from langchain_community.document_loaders import PyPDFLoader
+import numpy as np
+from google import genai
+from google.genai import types as genai_types
+from google.api_core import exceptions as google_exceptions
+from langchain_google_genai import GoogleGenerativeAIEmbeddings
+from langchain_community.document_loaders import PyMuPDFLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.vectorstores import Chroma
-from langchain.chains import RetrievalQA
-from langchain.prompts import PromptTemplate
+
+OUT_OF_CONTEXT_RESPONSE = ("⚠️ **Out of Context**: This question appears to be unrelated to medicine, healthcare, "
+                           "or medical science. Please ask medical or health-related questions only.")
+
+NO_LITERATURE_NOTE = ("\n\n⚠️ **Note**: No medical literature loaded. "
+                      "Response based on general medical knowledge only.")
+
+# Document-grounded analysis prompt filled per query
+ENHANCED_SKELETON = """Analyze the following medical question using the provided document contexts.
+
+Question: {q}
+
+Relevant Document Contexts:
+{ctx}
+
+Please provide:
+1. Direct answers found in the documents
+2. Key points from each relevant source
+3. Synthesis of information
+4. Additional considerations
+
+Response format:
+### 📑 Document Analysis
+[List key findings from documents]
+
+### 🔍 Detailed Answer
+[Comprehensive response]
+
+### 📚 Source Analysis
+[Break down of information by source]
+
+Response:"""
+
+CONTEXT_SKELETON = "Source: {source}\nContent: {content}"
+
+# General-knowledge prompt used when no documents match
+FALLBACK_SKELETON = """You are a medical AI assistant. Internally analyze the following medical question 
+to determine its type, complexity, and required expertise level. Based on your analysis, provide an appropriate 
+response without explicitly stating the analysis process.
+
+Question: {q}
+
+Instructions:
+- For clinical questions, structure your response with relevant medical reasoning and considerations
+- For general health questions, provide clear, direct answers with evidence-based guidance
+- For administrative queries, give straightforward practical responses
+- Adapt your response style and depth based on the question's complexity
+- Include relevant medical context only when necessary
+
+Note: Ensure responses follow evidence-based medical principles while maintaining appropriate scope.
+
+Response:"""
+
+# Generation settings for direct Gemini SDK calls (timeout is in milliseconds)
+LLM_MODEL = "gemini-2.5-flash"
+LLM_GENERATION_CONFIG = genai_types.GenerateContentConfig(temperature=0.3, max_output_tokens=8192)
+LLM_HTTP_OPTIONS = genai_types.HttpOptions(timeout=60_000)
+
+# Fast lexical first pass for the medical-question gate; whole words only,
+# so e.g. "surge", "nursery" or "healthiest" do not count as medical. Words with
+# common non-medical senses ("be patient", "treat yourself") are left to the
+# embedding check
+MEDICAL_TERMS_PATTERN = re.compile(
+    r"\b(?:"
+    # Clinical practice
+    r"symptoms?|diagnos(?:e|es|ed|ing|is|tic|tics)|treatments?|therap(?:y|ies|eutic)|"
+    r"prognosis|clinical|clinics?|medic(?:al|ine|ines|ation|ations)|drugs?|doses?|dosage|"
+    r"prescri(?:be|bed|ption|ptions)|surg(?:ery|eries|ical|eon|eons)|hospitals?|physicians?|doctors?|"
+    r"nurs(?:e|es|ing)|vaccin(?:e|es|ation)|antibiotics?|health(?:care)?|pathology|"
+    # Conditions
+    r"diseases?|disorders?|syndromes?|infections?|infected|cancers?|tumou?rs?|diabet(?:es|ic)|"
+    r"hypertension|cardiac|cardiovascular|pregnan(?:t|cy)|allerg(?:y|ies|ic)|asthma|"
+    r"anaemia|anemia|pneumonia|arthritis|migraines?|"
+    # Symptoms
+    r"pain(?:s|ful)?|aches?|headaches?|cough(?:s|ing)?|fever|nausea|vomit(?:ing)?|dizz(?:y|iness)|"
+    r"fatigue|rash(?:es)?|swelling|diarrh(?:o)?ea|breathless(?:ness)?|palpitations?|"
+    r"hurts?|sick|ill(?:ness|nesses)?|unwell|"
+    # Investigations
+    r"blood (?:pressure|tests?|sugar|counts?)|glucose|ha?emoglobin|hba1c|wbc|ferritin|"
+    r"lab (?:results?|values?|reports?)"
+    r")\b",
+    re.IGNORECASE
+)
+
+# Labeled questions for the embedding check used when no lexicon term matches.
+# A fixed cosine cutoff against one prototype does not separate classes with
+# embedding-001 (unrelated text often scores ~0.6 against medical text), so the
+# engine embeds these once at startup and accepts a question only when it is
+# closer to the medical centroid than to the non-medical one by
+# MEDICAL_CENTROID_MARGIN. The cutoff is thereby calibrated against the live model.
+MEDICAL_EXAMPLES = [
+    "What is the first-line management of community-acquired pneumonia?",
+    "How is lupus confirmed?",
+    "What are the diagnostic criteria for sepsis?",
+    "My stomach hurts after eating, what could cause it?",
+    "I feel unwell and tired all the time",
+    "What does a raised CRP indicate?",
+    "When should a patient with chest tightness go to A&E?",
+    "What are the side effects of metformin?",
+    "How do you manage an acute asthma exacerbation in children?",
+    "What causes jaundice in newborns?"
+]
+NON_MEDICAL_EXAMPLES = [
+    "Be patient with the build, it takes a few minutes",
+    "Treat yourself to a movie this weekend",
+    "What is the best stock to buy right now?",
+    "How do I fix a power surge in my house?",
+    "What time is the football match tonight?",
+    "Write a poem about the ocean",
+    "How do I reverse a linked list in Python?",
+    "What is the capital of Australia?",
+    "Recommend a good pasta recipe",
+    "How do I change a flat tyre?"
+]
+MEDICAL_CENTROID_MARGIN = 0.0
+
+# Cosine space matches the relevance math (1 - distance) used for contexts.
+# A higher construction_ef slows add_document once; every query benefits.
+HNSW_COLLECTION_METADATA = {
+    "hnsw:space": "cosine",
+    "hnsw:construction_ef": 200,
+    "hnsw:M": 32,
+    "hnsw:search_ef": 64
+}
+
+# Semantic response cache: near-duplicate questions in a session reuse a prior answer
+SEMANTIC_CACHE_THRESHOLD = 0.93
+
+# Near-duplicate clinical questions can differ only in a number, a population or
+# a negation ("type 1 vs type 2", "paediatric vs adult dose") and still embed
+# above the threshold, so a semantic hit also requires these terms to agree
+CACHE_GUARD_PATTERN = re.compile(
+    r"\d+(?:\.\d+)?|\b(?:type|adults?|child|children|paediatric|pediatric|infants?|neonatal|"
+    r"newborns?|elderly|pregnan(?:t|cy)|male|female|men|women|not|no|non|without|never|"
+    r"first|second|third|acute|chronic|mild|moderate|severe|upper|lower|left|right|"
+    r"oral|iv|intravenous|topical|before|after)\b",
+    re.IGNORECASE
+)
+SEMANTIC_CACHE_SIZE = 512
+
+# Top-hit cosine distance (lower is better) treated as an implicitly medical question.
+# 0.2 means similarity >= 0.8; unrelated text often reaches ~0.6 against a medical corpus
+STRONG_MATCH_DISTANCE = 0.2
+
+# Stop adding retrieved chunks to the prompt once either limit is reached.
+# Relevance is cosine similarity (1 - distance), summed over kept chunks: with
+# k=5 this keeps 2 chunks for strong hits (>= 0.8), about 3 for typical 0.6-0.7
+# hits and all 5 for weak ones. At 1000-char chunks (~250 tokens) the token
+# budget never binds for k=5; it only guards larger k.
+CONTEXT_RELEVANCE_TARGET = 1.6
+CONTEXT_TOKEN_BUDGET = 3500
+
+# Embedding work units are built with GoogleGenerativeAIEmbeddings' own request
+# batching (at most 100 texts and ~20k estimated tokens, so about 30 chunks of
+# 1000 chars), making each unit exactly one embedding request. At most
+# EMBED_CONCURRENCY requests are in flight per engine, across all uploads
+EMBED_BATCH_SIZE = 100
+EMBED_CONCURRENCY = 8
+
+# Chunks are written to Chroma in slices of this size
+CHROMA_ADD_BATCH_SIZE = 100
+
+# Rate-limited or transiently failing embedding requests are retried with
+# exponential backoff (1s, 2s, 4s, 8s plus jitter)
+EMBED_MAX_RETRIES = 4
+EMBED_BACKOFF_SECONDS = 1.0
+RETRYABLE_EMBED_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.DeadlineExceeded
+)
+
+# Uploaded PDFs are copied to disk in 1 MB chunks
+UPLOAD_COPY_CHUNK_SIZE = 1024 * 1024
+
+class ResponseCache:
+    """
+    Per-session response cache
+    Semantic lookups reuse an answer for a near-duplicate question; exact lookups
+    (for patient-specific queries) only match the same normalized question text
+    """
+    
+    def __init__(self, maxlen: int = SEMANTIC_CACHE_SIZE):
+        # Entries are (normalized text, unit query vector, guard terms, response, exact-only)
+        self._entries = deque(maxlen=maxlen)
+        self._corpus_version = None
+    
+    @staticmethod
+    def _normalize(question: str) -> str:
+        return " ".join(question.split()).lower()
+    
+    @staticmethod
+    def _guard_terms(question: str) -> frozenset:
+        """Numbers, populations and negations that must match for a semantic hit"""
+        return frozenset(term.lower() for term in CACHE_GUARD_PATTERN.findall(question))
+    
+    def _sync_version(self, corpus_version: int):
+        """Drop entries answered against a different set of documents"""
+        if corpus_version != self._corpus_version:
+            self._entries.clear()
+            self._corpus_version = corpus_version
+    
+    def lookup(self, question: str, query_vec: List[float], corpus_version: int,
+               exact: bool = False) -> Optional[str]:
+        """Return a cached response for the question, if any"""
+        self._sync_version(corpus_version)
+        entries = list(self._entries)
+        
+        if exact:
+            text = self._normalize(question)
+            for entry_text, _, _, response, _ in reversed(entries):
+                if entry_text == text:
+                    return response
+            return None
+        
+        # Exact-only entries never answer a merely similar question, and a similar
+        # question must agree on every guard term
+        guard = self._guard_terms(question)
+        entries = [entry for entry in entries if not entry[4] and entry[2] == guard]
+        if not entries:
+            return None
+        
+        q_vec = np.array(query_vec)
+        q_vec = q_vec / np.linalg.norm(q_vec)
+        similarities = np.stack([entry[1] for entry in entries]) @ q_vec
+        best = int(np.argmax(similarities))
+        if similarities[best] > SEMANTIC_CACHE_THRESHOLD:
+            return entries[best][3]
+        return None
+    
+    def store(self, question: str, query_vec: List[float], response: str,
+              corpus_version: int, exact: bool = False):
+        """Remember a generated response for later lookups"""
+        self._sync_version(corpus_version)
+        q_vec = np.array(query_vec)
+        self._entries.append((self._normalize(question), q_vec / np.linalg.norm(q_vec),
+                              self._guard_terms(question), response, exact))
 
 class MedicalRAGEngine:
     """
@@ -33,23 +279,21 @@ class MedicalRAGEngine:
         self.api_key = api_key
         self.persist_directory = persist_directory
         
-        # Configure Gemini
-        genai.configure(api_key=api_key)
-        
         # Initialize embeddings model
         self.embeddings = GoogleGenerativeAIEmbeddings(
             model="models/embedding-001",
             google_api_key=api_key
         )
         
-        # Initialize LLM - Gemini 2.5 Flash
-        self.llm = ChatGoogleGenerativeAI(
-            model="gemini-2.5-flash",
-            google_api_key=api_key,
-            temperature=0.3,
-            max_tokens=8192,
-            timeout=60
-        )
+        # Unit class centroids for the local medical-question gate, embedded as
+        # queries in one request like the questions they are compared with
+        self._med_centroid = self._centroid(MEDICAL_EXAMPLES)
+        self._non_med_centroid = self._centroid(NON_MEDICAL_EXAMPLES)
+        
+        # Initialize LLM - Gemini 2.5 Flash, called through the google-genai SDK directly.
+        # The client is keyed to this engine, unlike the process-wide genai.configure
+        # default, so engines for different API keys never share credentials
+        self.llm = genai.Client(api_key=api_key, http_options=LLM_HTTP_OPTIONS)
         
         # Initialize text splitter for medical documents
         self.text_splitter = RecursiveCharacterTextSplitter(
@@ -59,63 +303,44 @@ class MedicalRAGEngine:
             separators=["\n\n", "\n", ". ", " ", ""]
         )
         
+        # Bumped whenever documents change, invalidating per-session response caches
+        self._corpus_version = 0
+        
+        # Caps concurrent embedding batch requests across all add_document calls
+        self._embed_semaphore = threading.BoundedSemaphore(EMBED_CONCURRENCY)
+        
+        # Serializes vector store writes from concurrent add_document calls
+        self._write_lock = threading.Lock()
+        
+        # Content hashes of uploads currently being processed, guarded by _write_lock
+        self._pending_hashes = set()
+        
         # Initialize or load vector store
         self.vectorstore = None
         self._initialize_vectorstore()
         
-        # Clinical reasoning prompt template
-        self.prompt_template = self._create_clinical_prompt()
-        
     def _initialize_vectorstore(self):
-        """Initialize ChromaDB vector store"""
+        """Initialize ChromaDB vector store (Chroma creates the database if missing)"""
         try:
-            if os.path.exists(self.persist_directory):
-                # Load existing database
-                self.vectorstore = Chroma(
-                    persist_directory=self.persist_directory,
-                    embedding_function=self.embeddings
-                )
-            else:
-                # Create new database
-                self.vectorstore = Chroma(
-                    persist_directory=self.persist_directory,
-                    embedding_function=self.embeddings
-                )
+            self.vectorstore = self._open_vectorstore()
+            
+            # Chroma ignores collection_metadata for an existing collection, so an
+            # empty collection created with another space (e.g. the default l2) is
+            # recreated as cosine; a populated one keeps its space until cleared
+            collection = self.vectorstore._collection
+            space = (collection.metadata or {}).get("hnsw:space", "l2")
+            if space != HNSW_COLLECTION_METADATA["hnsw:space"] and collection.count() == 0:
+                self.vectorstore.delete_collection()
+                self.vectorstore = self._open_vectorstore()
         except Exception as e:
             raise Exception(f"Failed to initialize vector store: {str(e)}")
     
-    def _create_clinical_prompt(self) -> PromptTemplate:
-        """
-        Create structured clinical reasoning prompt template
-        Following evidence-based medical practice
-        """
-        template = """You are an expert medical AI assistant trained in clinical reasoning and diagnosis. 
-Use the provided medical literature context to answer the question with structured clinical reasoning.
-
-Medical Literature Context:
-{context}
-
-Question: {question}
-
-Instructions:
-1. **Patient Information Summary**: Organize all relevant patient data systematically
-2. **Clinical Reasoning Process**:
-   - Identify key symptoms, signs, and risk factors
-   - Apply clinical reasoning frameworks (analytical and intuitive)
-   - Consider pathophysiology and evidence-based guidelines
-3. **Differential Diagnosis**: List possible diagnoses in order of likelihood
-4. **Diagnostic Workup**: Recommend appropriate investigations
-5. **Clinical Recommendations**: Suggest evidence-based next steps
-6. **References**: Cite specific medical literature when applicable
-
-Provide a comprehensive, well-structured response following these steps.
-Ensure all recommendations are based on current medical evidence.
-
-Response:"""
-        
-        return PromptTemplate(
-            template=template,
-            input_variables=["context", "question"]
+    def _open_vectorstore(self) -> Chroma:
+        """Open (or create) the persisted Chroma collection"""
+        return Chroma(
+            persist_directory=self.persist_directory,
+            embedding_function=self.embeddings,
+            collection_metadata=HNSW_COLLECTION_METADATA
         )
     
     def add_document(self, file) -> Dict[str, Any]:
@@ -128,42 +353,73 @@ Response:"""
         Returns:
             Dictionary with processing status
         """
+        tmp_path = None
+        content_hash = None
         try:
-            # Save uploaded file temporarily
+            # Stream uploaded file to disk without holding it all in memory,
+            # hashing it in the same pass
+            hasher = hashlib.md5()
             with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp_file:
-                tmp_file.write(file.read())
                 tmp_path = tmp_file.name
+                file.seek(0)
+                for block in iter(lambda: file.read(UPLOAD_COPY_CHUNK_SIZE), b''):
+                    hasher.update(block)
+                    tmp_file.write(block)
             
-            # Load PDF document
-            loader = PyPDFLoader(tmp_path)
+            # Skip documents whose content is already stored or being processed by a
+            # concurrent call; the check and claim happen atomically under the lock
+            digest = hasher.hexdigest()
+            with self._write_lock:
+                existing = self.vectorstore._collection.get(where={'content_hash': digest}, limit=1)
+                if existing['ids'] or digest in self._pending_hashes:
+                    return {
+                        'status': 'skipped',
+                        'filename': file.name,
+                        'reason': 'Document already processed'
+                    }
+                content_hash = digest
+                self._pending_hashes.add(content_hash)
+            
+            # Load PDF document (PyMuPDF extracts text natively, far faster than pypdf)
+            loader = PyMuPDFLoader(tmp_path)
             documents = loader.load()
             
             # Split into chunks
             chunks = self.text_splitter.split_documents(documents)
-            
+
+            # Nothing to add, so leave the corpus and its cached answers untouched
+            if not chunks:
+                return {
+                    'status': 'error',
+                    'filename': file.name,
+                    'error': 'No extractable text found (scanned or image-only PDF?)'
+                }
+
             # Add metadata
             for i, chunk in enumerate(chunks):
                 chunk.metadata.update({
                     'source': file.name,
                     'chunk_id': i,
-                    'doc_type': 'medical_literature'
+                    'doc_type': 'medical_literature',
+                    'content_hash': content_hash
                 })
             
-            # Add to vector store
-            if self.vectorstore is None:
-                self.vectorstore = Chroma.from_documents(
-                    documents=chunks,
-                    embedding=self.embeddings,
-                    persist_directory=self.persist_directory
-                )
-            else:
-                self.vectorstore.add_documents(chunks)
-            
-            # Persist changes
-            self.vectorstore.persist()
-            
-            # Cleanup
-            os.unlink(tmp_path)
+            # Embed with concurrent single-request batches, then add the vectors directly
+            # so the vector store does not re-embed chunk by chunk
+            texts = [chunk.page_content for chunk in chunks]
+            vectors = self._embed_texts(texts)
+            with self._write_lock:
+                for start in range(0, len(chunks), CHROMA_ADD_BATCH_SIZE):
+                    end = start + CHROMA_ADD_BATCH_SIZE
+                    self.vectorstore._collection.add(
+                        ids=[str(uuid.uuid4()) for _ in texts[start:end]],
+                        embeddings=vectors[start:end],
+                        metadatas=[chunk.metadata for chunk in chunks[start:end]],
+                        documents=texts[start:end]
+                    )
+                
+                # Cached answers may no longer reflect the literature
+                self._corpus_version += 1
             
             return {
                 'status': 'success',
@@ -178,63 +434,168 @@ Response:"""
                 'filename': file.name if file else 'unknown',
                 'error': str(e)
             }
+        finally:
+            # Release the claimed hash; once added, its chunks make later checks skip
+            if content_hash is not None:
+                with self._write_lock:
+                    self._pending_hashes.discard(content_hash)
+            
+            # Cleanup, even when loading fails
+            if tmp_path and os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+    
+    def _embed_texts(self, texts: List[str]) -> List[List[float]]:
+        """Embed texts concurrently, one embedding request per batch"""
+        # Split exactly as embed_documents would, so it never re-splits a batch
+        batches = GoogleGenerativeAIEmbeddings._prepare_batches(texts, EMBED_BATCH_SIZE)
+        with ThreadPoolExecutor(max_workers=EMBED_CONCURRENCY) as executor:
+            results = list(executor.map(self._embed_batch, batches))
+        return [vector for batch in results for vector in batch]
+    
+    def _embed_batch(self, batch: List[str]) -> List[List[float]]:
+        """
+        Embed one single-request batch under the engine-wide concurrency cap,
+        retrying rate limits; a retry only resends this request's texts
+        """
+        for attempt in range(EMBED_MAX_RETRIES + 1):
+            with self._embed_semaphore:
+                try:
+                    return self.embeddings.embed_documents(batch, batch_size=EMBED_BATCH_SIZE)
+                except Exception as e:
+                    if attempt == EMBED_MAX_RETRIES or not self._is_retryable_error(e):
+                        raise
+            # Back off without holding a concurrency slot
+            time.sleep(EMBED_BACKOFF_SECONDS * 2 ** attempt + random.uniform(0, EMBED_BACKOFF_SECONDS))
+    
+    @staticmethod
+    def _is_retryable_error(error: Exception) -> bool:
+        """Whether an embedding error (possibly wrapped by langchain) is transient"""
+        return isinstance(error, RETRYABLE_EMBED_ERRORS) or isinstance(error.__cause__, RETRYABLE_EMBED_ERRORS)
+    
+    def flush(self):
+        """Persist vector store changes; call once after a batch of add_document calls"""
+        if self.vectorstore is not None:
+            with self._write_lock:
+                self.vectorstore.persist()
+    
+    def _centroid(self, examples: List[str]) -> np.ndarray:
+        """Unit mean of the unit query embeddings of the examples"""
+        vectors = np.array(self.embeddings.embed_documents(examples, task_type="RETRIEVAL_QUERY"))
+        vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        centroid = vectors.mean(axis=0)
+        return centroid / np.linalg.norm(centroid)
     
-    def _is_medical_question(self, question: str) -> bool:
-        """Check if the question is medical or health-related"""
+    def _is_medical_question(self, question: str, query_vec: Optional[List[float]] = None) -> bool:
+        """
+        Check if the question is medical or health-related
+        Uses a keyword pass first and falls back to the nearer of the medical and
+        non-medical example centroids, reusing query_vec when the caller has
+        already embedded the question
+        """
         try:
-            context_prompt = f"""Determine if this question is related to medicine, healthcare, or medical science.
-Question: {question}
-Return only 'true' or 'false'."""
+            if MEDICAL_TERMS_PATTERN.search(question):
+                return True
             
-            response = self.llm.invoke(context_prompt)
-            return 'true' in response.content.lower()
+            if query_vec is None:
+                query_vec = self.embeddings.embed_query(question)
+            q_vec = np.array(query_vec)
+            q_vec = q_vec / np.linalg.norm(q_vec)
+            margin = q_vec @ self._med_centroid - q_vec @ self._non_med_centroid
+            return float(margin) > MEDICAL_CENTROID_MARGIN
         except Exception:
             return True  # Default to assuming it's medical if check fails
     
+    def _generate(self, prompt: str) -> str:
+        """Generate a complete response for the prompt"""
+        response = self.llm.models.generate_content(
+            model=LLM_MODEL,
+            contents=prompt,
+            config=LLM_GENERATION_CONFIG
+        )
+        return response.text or ""
+    
+    def _generate_stream(self, prompt: str) -> Iterator[str]:
+        """Yield response text for the prompt as it is generated"""
+        for chunk in self.llm.models.generate_content_stream(
+            model=LLM_MODEL,
+            contents=prompt,
+            config=LLM_GENERATION_CONFIG
+        ):
+            # The final chunk may carry only finish metadata
+            if chunk.text:
+                yield chunk.text
+    
+    @staticmethod
+    def _build_fallback_prompt(question: str) -> str:
+        """Build the general-knowledge prompt used when no documents match"""
+        return FALLBACK_SKELETON.format(q=question)
+
     def _query_without_context(self, question: str) -> str:
         """
         Fallback query method when no documents are loaded
         Uses Gemini's base medical knowledge with internal question analysis
+        Callers run the medical-question gate first and handle errors
         """
-        try:
-            # Check if question is medical-related
-            if not self._is_medical_question(question):
-                return ("⚠️ **Out of Context**: This question appears to be unrelated to medicine, healthcare, "
-                       "or medical science. Please ask medical or health-related questions only.")
-                
-            fallback_prompt = f"""You are a medical AI assistant. Internally analyze the following medical question 
-to determine its type, complexity, and required expertise level. Based on your analysis, provide an appropriate 
-response without explicitly stating the analysis process.
-
-Question: {question}
-
-Instructions:
-- For clinical questions, structure your response with relevant medical reasoning and considerations
-- For general health questions, provide clear, direct answers with evidence-based guidance
-- For administrative queries, give straightforward practical responses
-- Adapt your response style and depth based on the question's complexity
-- Include relevant medical context only when necessary
-
-Note: Ensure responses follow evidence-based medical principles while maintaining appropriate scope.
-
-Response:"""
-            
-            response = self.llm.invoke(fallback_prompt)
-            return response.content + "\n\n⚠️ **Note**: No medical literature loaded. Response based on general medical knowledge only."
-            
-        except Exception as e:
-            return f"Error generating response: {str(e)}"
+        fallback_prompt = self._build_fallback_prompt(question)
+        
+        return self._generate(fallback_prompt) + NO_LITERATURE_NOTE
 
-    def _extract_relevant_contexts(self, question: str, k: int = 5) -> List[Dict[str, Any]]:
-        """Extract relevant contexts with metadata from documents"""
+    def _extract_relevant_contexts(self, query_vec: List[float], k: int = 5) -> List[Dict[str, Any]]:
+        """
+        Extract relevant contexts with metadata from documents
+        Searches by the precomputed question embedding so the question is not re-embedded
+        """
         if not self.vectorstore:
             return []
-            
-        results = self.vectorstore.similarity_search_with_score(
-            question,
+        
+        results = self.vectorstore.similarity_search_by_vector_with_relevance_scores(
+            query_vec,
             k=k
         )
         
+        return self._results_to_contexts(results)
+
+    def _retrieve_if_medical(self, question: str, k: int,
+                             query_vec: List[float]) -> Optional[List[Dict[str, Any]]]:
+        """
+        Retrieve contexts first and run the medical gate only when retrieval is weak
+        Returns None when the question is out of context
+        """
+        contexts = []
+        if self.vectorstore is not None and self.vectorstore._collection.count() > 0:
+            contexts = self._extract_relevant_contexts(query_vec, k)
+        
+        # A strong match against the medical literature implies a medical question
+        if contexts and contexts[0]['relevance_score'] < STRONG_MATCH_DISTANCE:
+            return self._select_contexts(contexts)
+        
+        if not self._is_medical_question(question, query_vec):
+            return None
+        return self._select_contexts(contexts)
+
+    @staticmethod
+    def _select_contexts(contexts: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Keep the most relevant contexts until their cumulative relevance reaches
+        CONTEXT_RELEVANCE_TARGET or the prompt would exceed CONTEXT_TOKEN_BUDGET
+        """
+        selected = []
+        total_relevance = 0.0
+        total_tokens = 0
+        for ctx in sorted(contexts, key=lambda c: c['relevance_score']):
+            tokens = len(ctx['content']) // 4  # rough chars-per-token estimate
+            if selected and (total_relevance >= CONTEXT_RELEVANCE_TARGET
+                             or total_tokens + tokens > CONTEXT_TOKEN_BUDGET):
+                break
+            selected.append(ctx)
+            total_relevance += max(0.0, 1 - ctx['relevance_score'])
+            total_tokens += tokens
+        
+        return selected
+
+    @staticmethod
+    def _results_to_contexts(results) -> List[Dict[str, Any]]:
+        """Convert (document, score) pairs into context dictionaries"""
         contexts = []
         for doc, score in results:
             contexts.append({
@@ -247,79 +608,112 @@ Response:"""
         
         return contexts
 
-    def query(self, question: str, k: int = 5) -> str:
-        """Query the RAG system with detailed context analysis"""
+    @staticmethod
+    def _build_enhanced_prompt(question: str, contexts: List[Dict[str, Any]]) -> str:
+        """Build the document-grounded analysis prompt"""
+        # Format contexts for prompt
+        context_text = "\n\n".join([CONTEXT_SKELETON.format(source=ctx['source'], content=ctx['content'])
+                                  for ctx in contexts])
+        
+        return ENHANCED_SKELETON.format(q=question, ctx=context_text)
+
+    @staticmethod
+    def _format_source_summary(contexts: List[Dict[str, Any]]) -> str:
+        """Summarize unique sources with their relevance"""
+        source_summary = "\n\n### 📚 Document Sources:\n"
+        seen_sources = set()
+        for ctx in contexts:
+            source = ctx['source']
+            if source not in seen_sources:
+                relevance = round((1 - ctx['relevance_score']) * 100, 2)
+                source_summary += f"- {source} (Relevance: {relevance}%)\n"
+                seen_sources.add(source)
+        
+        return source_summary
+
+    def query(self, question: str, k: int = 5, cache: Optional[ResponseCache] = None,
+              exact_match: bool = False) -> str:
+        """
+        Query the RAG system with detailed context analysis
+        Pass the session's cache to reuse prior answers; exact_match restricts it to
+        identical questions (for patient-specific queries)
+        """
         try:
-            # Check if question is medical-related
-            if not self._is_medical_question(question):
-                return ("⚠️ **Out of Context**: This question appears to be unrelated to medicine, healthcare, "
-                       "or medical science. Please ask medical or health-related questions only.")
-                       
-            if self.vectorstore is None or self.vectorstore._collection.count() == 0:
-                return self._query_without_context(question)
+            # Embed once for the response cache, the gate and retrieval
+            query_vec = self.embeddings.embed_query(question)
+            corpus_version = self._corpus_version
+            if cache is not None:
+                cached = cache.lookup(question, query_vec, corpus_version, exact_match)
+                if cached is not None:
+                    return cached
             
-            # Get relevant contexts
-            contexts = self._extract_relevant_contexts(question, k)
+            # Get relevant contexts, checking the question is medical-related
+            contexts = self._retrieve_if_medical(question, k, query_vec)
+            if contexts is None:
+                return OUT_OF_CONTEXT_RESPONSE
             if not contexts:
-                return self._query_without_context(question)
+                response = self._query_without_context(question)
+            else:
+                # Create enhanced prompt
+                enhanced_prompt = self._build_enhanced_prompt(question, contexts)
+                
+                # Answer directly from the already-retrieved contexts
+                response = self._generate(enhanced_prompt)
+                
+                # Add source summary
+                response += self._format_source_summary(contexts)
             
-            # Format contexts for prompt
-            context_text = "\n\n".join([f"Source: {ctx['source']}\nContent: {ctx['content']}" 
-                                      for ctx in contexts])
+            if cache is not None:
+                cache.store(question, query_vec, response, corpus_version, exact_match)
+            return response
             
-            # Create enhanced prompt
-            enhanced_prompt = f"""Analyze the following medical question using the provided document contexts.
-
-Question: {question}
-
-Relevant Document Contexts:
-{context_text}
-
-Please provide:
-1. Direct answers found in the documents
-2. Key points from each relevant source
-3. Synthesis of information
-4. Additional considerations
-
-Response format:
-### 📑 Document Analysis
-[List key findings from documents]
-
-### 🔍 Detailed Answer
-[Comprehensive response]
-
-### 📚 Source Analysis
-[Break down of information by source]
+        except Exception as e:
+            return f"Error processing query: {str(e)}"
 
-Response:"""
+    def stream_query(self, question: str, k: int = 5,
+                     query_vec: Optional[List[float]] = None,
+                     cache: Optional[ResponseCache] = None,
+                     exact_match: bool = False) -> Iterator[str]:
+        """
+        Query the RAG system, yielding the response as it is generated
+        Pass query_vec to reuse an embedding the caller already holds, and cache /
+        exact_match as in query
+        """
+        try:
+            # Embed once for the response cache, the gate and retrieval
+            if query_vec is None:
+                query_vec = self.embeddings.embed_query(question)
+            corpus_version = self._corpus_version
+            if cache is not None:
+                cached = cache.lookup(question, query_vec, corpus_version, exact_match)
+                if cached is not None:
+                    yield cached
+                    return
             
-            # Execute query with enhanced prompt
-            qa_chain = RetrievalQA.from_chain_type(
-                llm=self.llm,
-                chain_type="stuff",
-                retriever=self.vectorstore.as_retriever(search_kwargs={"k": k}),
-                chain_type_kwargs={"prompt": PromptTemplate(template=enhanced_prompt, 
-                                                         input_variables=["question"])},
-                return_source_documents=True
-            )
+            # Get relevant contexts, checking the question is medical-related
+            contexts = self._retrieve_if_medical(question, k, query_vec)
+            if contexts is None:
+                yield OUT_OF_CONTEXT_RESPONSE
+                return
             
-            result = qa_chain({"query": question})
-            response = result['result']
+            if contexts:
+                prompt = self._build_enhanced_prompt(question, contexts)
+                suffix = self._format_source_summary(contexts)
+            else:
+                prompt = self._build_fallback_prompt(question)
+                suffix = NO_LITERATURE_NOTE
             
-            # Add source summary
-            source_summary = "\n\n### 📚 Document Sources:\n"
-            seen_sources = set()
-            for ctx in contexts:
-                source = ctx['source']
-                if source not in seen_sources:
-                    relevance = round((1 - ctx['relevance_score']) * 100, 2)
-                    source_summary += f"- {source} (Relevance: {relevance}%)\n"
-                    seen_sources.add(source)
+            parts = []
+            for text in self._generate_stream(prompt):
+                parts.append(text)
+                yield text
+            yield suffix
             
-            return response + source_summary
+            if cache is not None:
+                cache.store(question, query_vec, "".join(parts) + suffix, corpus_version, exact_match)
             
         except Exception as e:
-            return f"Error processing query: {str(e)}"
+            yield f"Error processing query: {str(e)}"
     
     def get_database_stats(self) -> Dict[str, Any]:
         """Get statistics about the vector database"""
@@ -347,6 +741,7 @@ Response:"""
             if self.vectorstore:
                 self.vectorstore.delete_collection()
                 self._initialize_vectorstore()
+            self._corpus_version += 1
             return {'status': 'success', 'message': 'Database cleared'}
         except Exception as e:
             return {'status': 'error', 'error': str(e)}
\ No newline at end of file